@@ -1,23 +1,25 @@
 import sys
 import os
+import re
 import time
 
 import numpy as np
 import pandas as pd
 import geopandas as gpd
-import networkx as nx
 import osmium
 from osmium.geom import WKBFactory
-from geojson import Point, LineString, Feature, FeatureCollection
-from haversine import haversine_vector, Unit
-import pyproj
-from shapely.ops import transform
-from shapely.prepared import PreparedGeometry, prep
+from geojson import LineString, Feature, FeatureCollection
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+import shapely
 
 # Path to the OSM PBF file.
 OSM_FILE = "./data/osm/ile-de-france-2023-03-13.osm.pbf"
 # Path to the FlatGeobuf file where edges should be stored.
 EDGE_FILE = "./output/osm_network/osm_edges.fgb"
+# Path to the GeoParquet file where edges should be stored, in the metric CRS (this file is faster
+# to read than the FlatGeobuf file for the next scripts).
+EDGE_PARQUET_FILE = "./output/osm_network/osm_edges.parquet"
 # CRS to use for metric operations.
 METRIC_CRS = "EPSG:2154"
 # List of highway tags to consider.
@@ -136,6 +138,16 @@ DEFAULT_SPEED_URBAN = {
     "road": 20,
     "service": 20,
 }
+# Speed, in km/h, of the non-numerical `maxspeed` values.
+# See https://wiki.openstreetmap.org/wiki/Key:maxspeed
+MAXSPEED_LITERALS = {
+    "FR:walk": 20.0,
+    "FR:urban": 50.0,
+    "FR:rural": 80.0,
+}
+# Patterns of the numerical tag values that can be parsed.
+NUMBER_PATTERN = re.compile(r"\d+(?:\.\d+)?")
+INTEGER_PATTERN = re.compile(r"\d+")
 # Capacity of the different highway types (in PCE / hour).
 CAPACITY = {
     "motorway": 2000,
@@ -194,6 +206,21 @@ URBAN_LANDUSE = (
 )
 
 
+def parse_speed(value):
+    """Returns the speed (in km/h) of a `maxspeed` tag value, or None if it cannot be parsed."""
+    speed = MAXSPEED_LITERALS.get(value)
+    if speed is None and NUMBER_PATTERN.fullmatch(value):
+        speed = float(value)
+    return speed
+
+
+def parse_lanes(value):
+    """Returns the number of lanes of a `lanes` tag value, or None if it cannot be parsed."""
+    if INTEGER_PATTERN.fullmatch(value):
+        return int(value)
+    return None
+
+
 def valid_way(way):
     """Returns True if the way is a valid way to consider."""
     has_access = not "access" in way.tags or way.tags["access"] == "yes"
@@ -205,78 +232,62 @@ def is_urban_area(area):
     return area.tags.get("landuse") in URBAN_LANDUSE and (area.num_rings()[0] > 0)
 
 
-class UrbanAreasReader(osmium.SimpleHandler):
+class UrbanAreasReader:
     def __init__(self):
-        super().__init__()
         self.wkb_factory = WKBFactory()
         self.areas_wkb = list()
 
-    def area(self, area):
-        if not is_urban_area(area):
-            return
-        self.handle_area(area)
-
     def handle_area(self, area):
         self.areas_wkb.append(self.wkb_factory.create_multipolygon(area))
 
-    def get_urban_area(self):
-        polygons = gpd.GeoSeries.from_wkb(self.areas_wkb)
-        return polygons.unary_union
+    def get_urban_areas(self):
+        polygons = gpd.GeoSeries.from_wkb(self.areas_wkb, crs="EPSG:4326")
+        return polygons.to_crs(METRIC_CRS)
 
 
-class NodeReader(osmium.SimpleHandler):
+class NodeReader:
     def __init__(self):
-        super().__init__()
-        self.all_nodes = set()
-        self.nodes: dict[int, Feature] = dict()
+        # OSM ids of the nodes explored so far (stored as ints: osmium NodeRef objects hash by
+        # identity so they never match a node explored in another way).
+        self.seen_refs: set[int] = set()
+        # Mapping from the OSM id of the nodes to their id in the graph.
+        self.nodes: dict[int, int] = dict()
         self.counter = 0
 
-    def way(self, way):
-        if not valid_way(way):
-            return
-        self.handle_way(way)
-
     def handle_way(self, way):
+        nodes = way.nodes
         # Always add source and origin node.
-        self.add_node(way.nodes[0])
-        self.add_node(way.nodes[-1])
-        self.all_nodes.add(way.nodes[0])
-        self.all_nodes.add(way.nodes[-1])
+        self.add_node(nodes[0])
+        self.add_node(nodes[-1])
+        self.seen_refs.add(nodes[0].ref)
+        self.seen_refs.add(nodes[-1].ref)
         # Add the other nodes if they were already explored, i.e., they
         # intersect with another road.
-        for i in range(1, len(way.nodes) - 1):
-            node = way.nodes[i]
-            if node in self.all_nodes:
+        for i in range(1, len(nodes) - 1):
+            node = nodes[i]
+            ref = node.ref
+            if ref in self.seen_refs:
                 self.add_node(node)
-            self.all_nodes.add(node)
+            self.seen_refs.add(ref)
 
     def add_node(self, node):
         if node.ref in self.nodes:
             # Node was already added.
             return
         if node.location.valid():
-            self.nodes[node.ref] = Feature(
-                geometry=Point((node.lon, node.lat)),
-                properties={"id": self.counter, "osm_id": node.ref},
-            )
+            self.nodes[node.ref] = self.counter
             self.counter += 1
 
 
-class EdgeReader(osmium.SimpleHandler):
+class EdgeReader:
     def __init__(self, nodes):
-        super().__init__()
         self.nodes = nodes
+        # Data of the valid ways, stored until all the nodes are known.
+        self.ways = list()
         self.edges = list()
         self.counter = 0
 
-    def way(self, way):
-        self.add_way(way)
-
-    def add_way(self, way):
-
-        if not valid_way(way):
-            return
-
+    def store_way(self, way):
         road_type = way.tags.get("highway", None)
         road_type_id = ROADTYPE_TO_ID[road_type]
 
@@ -292,94 +303,65 @@ class EdgeReader(osmium.SimpleHandler):
         )
 
         # Find maximum speed if available.
-        maxspeed = way.tags.get("maxspeed", "")
-        speed = None
+        speed = parse_speed(way.tags.get("maxspeed", ""))
         back_speed = None
-        if maxspeed == "FR:walk":
-            speed = 20
-        elif maxspeed == "FR:urban":
-            speed = 50
-        elif maxspeed == "FR:rural":
-            speed = 80
-        else:
-            try:
-                speed = float(maxspeed)
-            except ValueError:
-                pass
         if not oneway:
-            try:
-                speed = float(way.tags.get("maxspeed:forward", "0")) or speed
-            except ValueError:
-                pass
-            try:
-                back_speed = float(way.tags.get("maxspeed:backward", "0")) or speed
-            except ValueError:
-                pass
+            speed = parse_speed(way.tags.get("maxspeed:forward", "")) or speed
+            back_speed = parse_speed(way.tags.get("maxspeed:backward", "")) or speed
 
         # Find number of lanes if available.
-        lanes = None
+        total_lanes = parse_lanes(way.tags.get("lanes", ""))
         back_lanes = None
         if oneway:
-            try:
-                lanes = int(way.tags.get("lanes", ""))
-            except ValueError:
-                pass
-            else:
-                lanes = max(lanes, 1)
+            lanes = total_lanes
         else:
-            try:
-                lanes = (
-                    int(way.tags.get("lanes:forward", "0")) or int(way.tags.get("lanes", "")) // 2
-                )
-            except ValueError:
-                pass
-            else:
-                lanes = max(lanes, 1)
-            try:
-                back_lanes = (
-                    int(way.tags.get("lanes:backward", "0")) or int(way.tags.get("lanes", "")) // 2
-                )
-            except ValueError:
-                pass
-            else:
-                back_lanes = max(back_lanes, 1)
+            half_lanes = total_lanes // 2 if total_lanes is not None else None
+            lanes = parse_lanes(way.tags.get("lanes:forward", "")) or half_lanes
+            back_lanes = parse_lanes(way.tags.get("lanes:backward", "")) or half_lanes
         if lanes is None:
             lanes = DEFAULT_LANES.get(road_type, 1)
+        else:
+            lanes = max(lanes, 1)
         if back_lanes is None:
             back_lanes = DEFAULT_LANES.get(road_type, 1)
+        else:
+            back_lanes = max(back_lanes, 1)
 
         capacity = CAPACITY.get(road_type)
 
-        for i, node in enumerate(way.nodes):
-            if node.ref in self.nodes:
-                source = i
-                break
-        else:
-            # No node of the way is in the nodes.
-            return
+        # The node references and locations are only valid during the pass over the file so they
+        # are copied.
+        refs = list()
+        coords = list()
+        for node in way.nodes:
+            refs.append(node.ref)
+            coords.append((node.lon, node.lat) if node.location.valid() else None)
+
+        self.ways.append(
+            (
+                way.id,
+                refs,
+                coords,
+                (oneway, name, road_type_id, lanes, back_lanes, speed, back_speed, capacity),
+            )
+        )
 
-        j = source + 1
-        for i, node in enumerate(list(way.nodes)[j:]):
-            if node.ref in self.nodes:
-                target = j + i
-                self.add_edge(
-                    way,
-                    source,
-                    target,
-                    oneway,
-                    name,
-                    road_type_id,
-                    lanes,
-                    back_lanes,
-                    speed,
-                    back_speed,
-                    capacity,
-                )
-                source = target
+    def add_ways(self):
+        for way_id, refs, coords, attributes in self.ways:
+            self.add_way(way_id, refs, coords, attributes)
+        self.ways = list()
+
+    def add_way(self, way_id, refs, coords, attributes):
+        # Indices of the way's nodes which are nodes of the graph.
+        hits = [i for i, ref in enumerate(refs) if ref in self.nodes]
+        for source, target in zip(hits, hits[1:]):
+            self.add_edge(way_id, refs, coords, source, target, *attributes)
 
     def add_edge(
         self,
-        way,
+        way_id,
+        refs,
+        coords,
         source,
         target,
         oneway,
@@ -391,17 +373,14 @@ class EdgeReader(osmium.SimpleHandler):
         back_speed,
         capacity,
     ):
-        source_id = self.nodes[way.nodes[source].ref].properties["id"]
-        target_id = self.nodes[way.nodes[target].ref].properties["id"]
+        source_id = self.nodes[refs[source]]
+        target_id = self.nodes[refs[target]]
         if source_id == target_id:
             # Self-loop.
             return
 
         # Create a geometry of the road.
-        coords = list()
-        for i in range(source, target + 1):
-            if way.nodes[i].location.valid():
-                coords.append((way.nodes[i].lon, way.nodes[i].lat))
+        coords = [c for c in coords[source : target + 1] if c is not None]
         geometry = LineString(coords)
         back_geometry = None
         if not oneway:
@@ -414,9 +393,6 @@ class EdgeReader(osmium.SimpleHandler):
             back_edge_id = self.counter
             self.counter += 1
 
-        # Compute length in meters.
-        length = np.sum(haversine_vector(coords[:-1], coords[1:], Unit.KILOMETERS)) * 1000
-
         self.edges.append(
             Feature(
                 geometry=geometry,
@@ -425,12 +401,11 @@ class EdgeReader(osmium.SimpleHandler):
                     "name": name,
                     "road_type": road_type,
                     "lanes": lanes,
-                    "length": length,
                     "speed": speed,
                     "capacity": capacity,
                     "source": source_id,
                     "target": target_id,
-                    "osm_id": way.id,
+                    "osm_id": way_id,
                 },
             )
         )
@@ -444,40 +419,45 @@ class EdgeReader(osmium.SimpleHandler):
                         "name": name,
                         "road_type": road_type,
                         "lanes": back_lanes,
-                        "length": length,
                         "speed": back_speed,
                         "capacity": capacity,
                         "source": target_id,
                         "target": source_id,
-                        "osm_id": way.id,
+                        "osm_id": way_id,
                     },
                 )
             )
 
-    def post_process(self, urban_area: PreparedGeometry):
+    def post_process(self, urban_areas: gpd.GeoSeries):
         edge_collection = FeatureCollection(self.edges)
         edges = gpd.GeoDataFrame.from_features(edge_collection, crs="epsg:4326")
 
+        # Compute length in meters, projecting all the edges at once.
+        metric_geoms = edges.geometry.to_crs(METRIC_CRS)
+        edges["length"] = metric_geoms.length
+
         print("Finding the largest strongly connected component")
 
-        G = nx.DiGraph()
-        G.add_edges_from(
-            map(
-                lambda keyrow: (keyrow[1]["source"], keyrow[1]["target"]),
-                edges[["source", "target"]].iterrows(),
-            )
+        sources = edges["source"].to_numpy()
+        targets = edges["target"].to_numpy()
+        nb_nodes = max(sources.max(), targets.max()) + 1
+        adjacency = csr_matrix(
+            (np.ones(len(edges), dtype=bool), (sources, targets)), shape=(nb_nodes, nb_nodes)
         )
-        # Find the nodes of the largest strongly connected component.
-        connected_nodes = max(nx.strongly_connected_components(G), key=len)
-        if len(connected_nodes) < G.number_of_nodes():
+        _, labels = connected_components(adjacency, directed=True, connection="strong")
+        # Find the label of the largest strongly connected component (among the nodes which are
+        # used by at least one edge).
+        graph_nodes = np.union1d(sources, targets)
+        largest = np.bincount(labels[graph_nodes]).argmax()
+        nb_disconnected = np.sum(labels[graph_nodes] != largest)
+        if nb_disconnected:
             print(
                 "Warning: discarding {} nodes disconnected from the main graph".format(
-                    G.number_of_nodes() - len(connected_nodes)
+                    nb_disconnected
                 )
             )
-            edges = edges.loc[
-                (edges["source"].isin(connected_nodes)) & (edges["target"].isin(connected_nodes))
-            ].copy()
+            mask = (labels[sources] == largest) & (labels[targets] == largest)
+            edges = edges.loc[mask].copy()
 
         print("Finding parallel edges")
 
@@ -489,8 +469,26 @@ class EdgeReader(osmium.SimpleHandler):
         od_forbidden = list(map(lambda h: ROADTYPE_TO_ID[h], OD_FORBIDDEN))
         edges["allow_od"] = ~edges["road_type"].isin(od_forbidden)
 
+        # Flag the edges which lie in the urban areas (in the metric CRS).
+        polygons = urban_areas.values
+        tree = shapely.STRtree(polygons)
+        geoms = metric_geoms.loc[edges.index].values
+        edge_idx, _ = tree.query(geoms, predicate="within")
+        urban = np.zeros(len(edges), dtype=bool)
+        urban[edge_idx] = True
+        # The other edges can still lie in the urban areas if they cross the border between two
+        # overlapping polygons: test them against the union of the polygons they intersect.
+        candidates = np.flatnonzero(~urban)
+        edge_idx, poly_idx = tree.query(geoms[candidates], predicate="intersects")
+        order = np.argsort(edge_idx, kind="stable")
+        counts = np.bincount(edge_idx, minlength=len(candidates))
+        poly_groups = np.split(poly_idx[order], np.cumsum(counts)[:-1])
+        for i in np.flatnonzero(counts >= 2):
+            urban_area = shapely.union_all(polygons[poly_groups[i]])
+            urban[candidates[i]] = shapely.contains(urban_area, geoms[candidates[i]])
+        edges["urban"] = urban
+
         # Set speed of edges to default speed if NA.
-        edges["urban"] = [urban_area.contains(geom) for geom in edges.geometry]
         urban_speeds = pd.DataFrame(
             list(DEFAULT_SPEED_URBAN.values()),
             index=list(DEFAULT_SPEED_URBAN.keys()),
@@ -508,32 +506,16 @@ class EdgeReader(osmium.SimpleHandler):
         edges.loc[edges["speed"].isna() & ~edges["urban"], "speed"] = edges["rural_speed"]
 
         # Removing duplicate edges.
-        st_count = edges.value_counts(subset=["source", "target"])
-        to_remove = list()
-        for s, t in st_count.loc[st_count > 1].index:
-            dupl = edges.loc[(edges["source"] == s) & (edges["target"] == t)]
-            # Keep in priority (i) main graph edge, (ii) largest capacity edge, (iii) smallest
-            # free-flow travel time edge.
-            nb_mains = dupl["main_graph"].sum()
-            nb_secondary = len(dupl) - nb_mains
-            indices = list()
-            if nb_mains == 1:
-                indices.extend(dupl.loc[~dupl["main_graph"]].index)
-            else:
-                if nb_mains > 0 and nb_secondary > 0:
-                    indices.extend(dupl.loc[~dupl["main_graph"]].index)
-                    dupl = dupl.loc[dupl["main_graph"]].copy()
-                max_capacity = dupl["capacity"].max()
-                indices.extend(dupl.loc[dupl["capacity"] < max_capacity].index)
-                dupl = dupl.loc[dupl["capacity"] == max_capacity].copy()
-                if len(dupl) > 1:
-                    tt = dupl["length"] / (dupl["speed"] / 3.6)
-                    id_min = tt.index[tt.argmin()]
-                    indices.extend(dupl.loc[dupl.index != id_min].index)
-            to_remove.extend(indices)
-        if to_remove:
-            print("Warning. Removing {} duplicate edges.".format(len(to_remove)))
-            edges.drop(labels=to_remove, inplace=True)
+        # Keep in priority (i) main graph edge, (ii) largest capacity edge, (iii) smallest
+        # free-flow travel time edge.
+        edges["tt"] = edges["length"] / (edges["speed"] / 3.6)
+        nb_edges = len(edges)
+        edges = edges.sort_values(
+            ["main_graph", "capacity", "tt"], ascending=[False, False, True], kind="stable"
+        )
+        edges = edges.drop_duplicates(subset=["source", "target"]).sort_index()
+        if len(edges) < nb_edges:
+            print("Warning. Removing {} duplicate edges.".format(nb_edges - len(edges)))
 
         # Add a column for the indices of the edges (in the full network).
         edges.reset_index(inplace=True, drop=True)
@@ -562,22 +544,37 @@ class EdgeReader(osmium.SimpleHandler):
 
         self.edges_df = edges
 
-    def write_edges(self, filename):
+    def write_edges(self, filename, parquet_filename):
         dirname = os.path.dirname(filename)
         if not os.path.isdir(dirname):
             os.makedirs(dirname)
-        self.edges_df.to_file(filename, driver="FlatGeobuf")
+        self.edges_df.to_file(filename, driver="FlatGeobuf", engine="pyogrio")
+        self.edges_df.to_crs(METRIC_CRS).to_parquet(parquet_filename, compression="zstd")
+
 
+class OSMReader(osmium.SimpleHandler):
+    """Reads the nodes, the edges and the urban areas in a single pass over the OSM file.
 
-def buffer(geom, distance):
-    wgs84 = pyproj.CRS("EPSG:4326")
-    metric_crs = pyproj.CRS(METRIC_CRS)
-    project = pyproj.Transformer.from_crs(wgs84, metric_crs, always_xy=True).transform
-    inverse_project = pyproj.Transformer.from_crs(metric_crs, wgs84, always_xy=True).transform
-    metric_geom = transform(project, geom)
-    buffered_geom = metric_geom.buffer(distance).simplify(0, preserve_topology=False)
-    geom = transform(inverse_project, buffered_geom)
-    return geom
+    The edges can only be created once all the intersection nodes are known so the valid ways are
+    stored by the EdgeReader and their edges are created after the pass, with `add_ways`.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.node_reader = NodeReader()
+        self.edge_reader = EdgeReader(self.node_reader.nodes)
+        self.area_reader = UrbanAreasReader()
+
+    def way(self, way):
+        if not valid_way(way):
+            return
+        self.node_reader.handle_way(way)
+        self.edge_reader.store_way(way)
+
+    def area(self, area):
+        if not is_urban_area(area):
+            return
+        self.area_reader.handle_area(area)
 
 
 if __name__ == "__main__":
@@ -589,28 +586,24 @@ if __name__ == "__main__":
         print("File not found: {}".format(OSM_FILE))
         sys.exit(0)
 
-    print("Finding nodes...")
-    node_reader = NodeReader()
-    node_reader.apply_file(OSM_FILE, locations=True, idx="flex_mem")
+    print("Reading nodes, ways and urban areas...")
+    reader = OSMReader()
+    reader.apply_file(OSM_FILE, locations=True, idx="flex_mem")
 
-    print("Reading edges...")
-    edge_reader = EdgeReader(node_reader.nodes)
-    edge_reader.apply_file(OSM_FILE, locations=True, idx="flex_mem")
+    print("Creating edges...")
+    edge_reader = reader.edge_reader
+    edge_reader.add_ways()
 
-    print("Finding urban areas...")
-    area_reader = UrbanAreasReader()
-    area_reader.apply_file(OSM_FILE, locations=True, idx="flex_mem")
-    urban_area = area_reader.get_urban_area()
+    urban_areas = reader.area_reader.get_urban_areas()
 
     # Buffer the urban areas by 50 meters to capture all nearby roads.
-    urban_area = buffer(urban_area, 50)
-    urban_area = prep(urban_area)
+    urban_areas = urban_areas.buffer(50)
 
     print("Post-processing...")
-    edge_reader.post_process(urban_area)
+    edge_reader.post_process(urban_areas)
 
     print("Writing edges...")
-    edge_reader.write_edges(EDGE_FILE)
+    edge_reader.write_edges(EDGE_FILE, EDGE_PARQUET_FILE)
 
     print("Done!")
 
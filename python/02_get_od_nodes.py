@@ -1,13 +1,10 @@
 import os
 import time
 
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Point
-
-from tqdm import tqdm
-
-tqdm.pandas()
+import shapely
 
 # Path to the CSV file with the trips of the synthetic population (including x0, y0, x1 and y1
 # columns).
@@ -20,13 +17,13 @@ START_TIME = 0.0 * 3600.0
 # Returns only trips whose arrival time is earlier than this value (in seconds after midnight).
 END_TIME = 30.0 * 3600.0
 
-# Path to the FlatGeobuf file where edges are stored.
-EDGE_FILE = "./output/osm_network/osm_edges.fgb"
+# Path to the GeoParquet file where edges are stored (in the metric CRS).
+EDGE_FILE = "./output/osm_network/osm_edges.parquet"
 # CRS to use for metric operations.
 METRIC_CRS = "EPSG:2154"
 
 # Path to the files where the output trips should be stored.
-OUTPUT_FILE = "./output/trips/trips.csv"
+OUTPUT_FILE = "./output/trips/trips.parquet"
 
 
 def prepare_trips():
@@ -52,14 +49,16 @@ def prepare_trips():
 
 def read_edges():
     print("Reading edges")
-    edges = gpd.read_file(EDGE_FILE)
-    edges.to_crs(METRIC_CRS, inplace=True)
+    # Read only the edges that can be used as origin / destination edge.
+    edges = gpd.read_parquet(EDGE_FILE, filters=[("allow_od", "==", True)])
     edges.sort_values('index', inplace=True)
-    # Return only the edges that can be used as origin / destination edge.
-    edges = edges.loc[edges["allow_od"]].copy()
     # Create source and target points.
-    edges["source_point"] = edges["geometry"].apply(lambda g: Point(g.coords[0]))
-    edges["target_point"] = edges["geometry"].apply(lambda g: Point(g.coords[-1]))
+    edges["source_point"] = gpd.GeoSeries(
+        shapely.get_point(edges.geometry.values, 0), index=edges.index, crs=edges.crs
+    )
+    edges["target_point"] = gpd.GeoSeries(
+        shapely.get_point(edges.geometry.values, -1), index=edges.index, crs=edges.crs
+    )
     return edges
 
 
@@ -77,32 +76,26 @@ def nearjoin(gdf, edges):
 
     print("Compute distance node ...")
     # set source / target point distance
-    print("  sources")
-    nearedges["source_dist"] = nearedges.progress_apply(
-        lambda e: e["geometry"].distance(e["source_point"]), axis=1
-    )
-    print("  targets")
-    nearedges["target_dist"] = nearedges.progress_apply(
-        lambda e: e["geometry"].distance(e["target_point"]), axis=1
-    )
+    geoms = nearedges.geometry.values
+    nearedges["source_dist"] = shapely.distance(geoms, nearedges["source_point"].values)
+    nearedges["target_dist"] = shapely.distance(geoms, nearedges["target_point"].values)
     # True when source closer, False when target is closer.
     print("Find nearest node...")
     nearedges["nearest"] = nearedges["source_dist"] < nearedges["target_dist"]
     # set connector value acconrdingly
-    print("Assignating values:")
-    nearedges["connect"] = None
-    nearedges["connect_dist"] = None
-    nearedges["geometry"] = None
-    print("-when source is near")
-    mask = nearedges["nearest"]
-    nearedges.loc[mask, "connect"] = nearedges.loc[mask, "source"]
-    nearedges.loc[mask, "connect_dist"] = nearedges.loc[mask, "source_dist"]
-    nearedges.loc[mask, "geometry"] = nearedges.loc[mask, "source_point"]
-    print("-when target is near")
-    mask = ~nearedges["nearest"]
-    nearedges.loc[mask, "connect"] = nearedges.loc[mask, "target"]
-    nearedges.loc[mask, "connect_dist"] = nearedges.loc[mask, "target_dist"]
-    nearedges.loc[mask, "geometry"] = nearedges.loc[mask, "target_point"]
+    print("Assignating values")
+    nearest = nearedges["nearest"].to_numpy()
+    nearedges["connect"] = np.where(
+        nearest, nearedges["source"].to_numpy(), nearedges["target"].to_numpy()
+    )
+    nearedges["connect_dist"] = np.where(
+        nearest, nearedges["source_dist"].to_numpy(), nearedges["target_dist"].to_numpy()
+    )
+    nearedges["geometry"] = gpd.GeoSeries(
+        np.where(nearest, nearedges["source_point"].values, nearedges["target_point"].values),
+        index=nearedges.index,
+        crs=METRIC_CRS,
+    )
 
     nearedges.drop(
         columns=[
@@ -151,7 +144,10 @@ if __name__ == "__main__":
     dirname = os.path.dirname(OUTPUT_FILE)
     if not os.path.isdir(dirname):
         os.makedirs(dirname)
-    trips.to_csv(OUTPUT_FILE, index=False)
+    # The origin / destination points are not stored (they are given by the x0, y0, x1, y1
+    # columns).
+    trips = pd.DataFrame(trips.drop(columns=["origin", "destination"]))
+    trips.to_parquet(OUTPUT_FILE, index=False, compression="zstd")
 
     t = time.time() - t0
     print("Total running time: {:.2f} seconds".format(t))
@@ -1,18 +1,15 @@
 import os
 import time
-import json
 import subprocess
 
+import orjson
 import pandas as pd
-import geopandas as gpd
 
 # Path to the files where the trips are stored.
-TRIPS_FILE = "./output/trips/trips.csv"
+TRIPS_FILE = "./output/trips/trips.parquet"
 
-# Path to the FlatGeobuf file where edges are stored.
-EDGE_FILE = "./output/osm_network/osm_edges.fgb"
-# CRS to use for metric operations.
-METRIC_CRS = "EPSG:2154"
+# Path to the GeoParquet file where edges are stored.
+EDGE_FILE = "./output/osm_network/osm_edges.parquet"
 
 # Directory where temporary files for the routing script should be stored.
 ROUTING_DIR = "./output/routing/"
@@ -27,13 +24,14 @@ PARAMETERS = {
 
 def read_trips():
     print("Reading trips")
-    return pd.read_csv(TRIPS_FILE)
+    return pd.read_parquet(TRIPS_FILE)
 
 
 def read_edges():
     print("Reading edges")
-    edges = gpd.read_file(EDGE_FILE)
-    edges.to_crs(METRIC_CRS, inplace=True)
+    edges = pd.read_parquet(
+        EDGE_FILE, columns=["index", "source", "target", "length", "speed", "main_graph"]
+    )
     edges.sort_values('index', inplace=True)
 
     # Computes edges' travel time in seconds.
@@ -51,24 +49,24 @@ def prepare_shortestpath(trips, edges):
     print("Creating queries")
     trips["departure_time"] = 0.0
     columns = ["trip_id", "O_connect", "D_connect", "departure_time"]
-    queries = [*map(tuple, zip(*map(trips.get, columns)))]
+    queries = trips[columns].to_records(index=False).tolist()
 
     print("Creating Graph")
     columns = ["source", "target", "tt"]
-    graph = [*map(tuple, zip(*map(edges.get, columns)))]
+    graph = edges[columns].to_records(index=False).tolist()
 
     print("Writing data...")
     if not os.path.isdir(ROUTING_DIR):
         os.makedirs(ROUTING_DIR)
     print("Queries")
-    with open(os.path.join(ROUTING_DIR, "queries.json"), "w") as f:
-        json.dump(queries, f)
+    with open(os.path.join(ROUTING_DIR, "queries.json"), "wb") as f:
+        f.write(orjson.dumps(queries))
     print("Graph")
-    with open(os.path.join(ROUTING_DIR, "graph.json"), "w") as f:
-        json.dump(graph, f)
+    with open(os.path.join(ROUTING_DIR, "graph.json"), "wb") as f:
+        f.write(orjson.dumps(graph))
     print("Parameters")
-    with open(os.path.join(ROUTING_DIR, "parameters.json"), "w") as f:
-        json.dump(PARAMETERS, f)
+    with open(os.path.join(ROUTING_DIR, "parameters.json"), "wb") as f:
+        f.write(orjson.dumps(PARAMETERS))
 
     print("Done!")
 
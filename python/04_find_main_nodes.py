@@ -1,29 +1,27 @@
-from collections import defaultdict
+import itertools
 import os
 import time
-import json
 
 import numpy as np
+import orjson
 import pandas as pd
 import geopandas as gpd
-import networkx as nx
-
-# library to replace apply with progress_apply and prompt the progress of the pandas operation
-from tqdm import tqdm
-
-tqdm.pandas()
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 
 # Path to the FlatGeobuf file where edges are stored.
 EDGE_FILE = "./output/osm_network/osm_edges.fgb"
+# Path to the Parquet file where the edges attributes (without geometry) should be stored.
+EDGE_ATTRS_FILE = "./output/osm_network/osm_edges_attrs.parquet"
 # Directory where temporary files for the routing script are stored.
 ROUTING_DIR = "./output/routing/"
 # Path to the files where the trips are stored.
-TRIPS_FILE = "./output/trips/trips.csv"
+TRIPS_FILE = "./output/trips/trips.parquet"
 
 
 def read_edges():
     print("Reading edges")
-    edges = gpd.read_file(EDGE_FILE)
+    edges = gpd.read_file(EDGE_FILE, engine="pyogrio", use_arrow=True)
     edges.set_index("index", inplace=True)
     edges.sort_index(inplace=True)
 
@@ -39,55 +37,89 @@ def read_edges():
 
 
 def load_results():
+    """Returns the DataFrame of the routing results (trip id and travel time), the concatenation of
+    all the routes and the offsets of the routes (see `flatten_routes`)."""
     print("Reading routing results")
-    with open(os.path.join(ROUTING_DIR, "output.json"), "r") as f:
-        data = json.load(f)
-    return pd.DataFrame(list(data["results"]), columns=["trip_id", "travel_time", "route"])
+    with open(os.path.join(ROUTING_DIR, "output.json"), "rb") as f:
+        data = orjson.loads(f.read())["results"]
+    edges_flat, offsets = flatten_routes([r[2] for r in data])
+    results = pd.DataFrame(
+        {
+            "trip_id": np.fromiter((r[0] for r in data), dtype=np.int64, count=len(data)),
+            "travel_time": np.fromiter((r[1] for r in data), dtype=np.float64, count=len(data)),
+        }
+    )
+    return results, edges_flat, offsets
 
 
 def read_trips():
     print("Reading trips")
-    return pd.read_csv(TRIPS_FILE)
+    trips = pd.read_parquet(TRIPS_FILE)
+    trips["trip_id"] = trips["trip_id"].astype(np.int32)
+    return trips
 
 
-def find_connections(results, edges):
+def flatten_routes(routes):
+    """Returns the concatenation of all the routes, as an array of edge ids, and the offsets of the
+    routes in this array (route `i` is `edges_flat[offsets[i] : offsets[i + 1]]`)."""
+    lengths = np.fromiter(map(len, routes), dtype=np.int64, count=len(routes))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    edges_flat = np.fromiter(
+        itertools.chain.from_iterable(routes), dtype=np.int32, count=offsets[-1]
+    )
+    return edges_flat, offsets
+
+
+def first_last_main(is_main_flat, offsets):
+    """Returns the index of the first and last main edge of each route (NaN for the routes with no
+    main edge), given the boolean array flagging the main edges of the concatenated routes."""
+    first = np.full(len(offsets) - 1, np.nan)
+    last = np.full(len(offsets) - 1, np.nan)
+    positions = np.flatnonzero(is_main_flat)
+    if len(positions):
+        # Index of the route of each main edge (positions and route indices are both sorted).
+        route_idx = np.searchsorted(offsets, positions, side="right") - 1
+        routes, first_pos = np.unique(route_idx, return_index=True)
+        last_pos = np.append(first_pos[1:], len(positions)) - 1
+        first[routes] = positions[first_pos] - offsets[routes]
+        last[routes] = positions[last_pos] - offsets[routes]
+    return first, last
+
+
+def find_connections(results, edges_flat, offsets, edges):
     print("Prepare edges data")
     main_edges = set(edges.loc[edges["main_graph"]].index)
-    edge_time = edges["tt"].to_dict()
-    edge_source = edges["source"].to_dict()
-    edge_target = edges["target"].to_dict()
-
-    print("Find the first / last main edge")
+    # Flag of the main edges, travel time, source and target of the edges, indexed by edge id.
+    nb_ids = edges.index.max() + 1
+    is_main = np.zeros(nb_ids, dtype=bool)
+    is_main[edges.index[edges["main_graph"]]] = True
+    edge_time = edges["tt"].reindex(np.arange(nb_ids), fill_value=0.0).to_numpy()
+    edge_source = edges["source"].reindex(np.arange(nb_ids), fill_value=-1).to_numpy()
+    edge_target = edges["target"].reindex(np.arange(nb_ids), fill_value=-1).to_numpy()
 
-    def first_main_index(route):
-        for i, x in enumerate(route):
-            if x in main_edges:
-                return i
+    results["start"] = offsets[:-1]
+    results["end"] = offsets[1:]
 
-    def last_main_index(route):
-        for i, x in enumerate(route[::-1]):
-            if x in main_edges:
-                return len(route) - i - 1
-
-    results["first"] = results["route"].progress_apply(first_main_index)
-    results["last"] = results["route"].progress_apply(last_main_index)
+    print("Find the first / last main edge")
+    first, last = first_last_main(is_main[edges_flat], offsets)
+    results["first"] = first
+    results["last"] = last
 
     results["main_only"] = ~results["first"].isna()
 
     print("Find how many residential edges are used in the middle of main trips")
-    results["middle_residential"] = None
-    results.loc[results["main_only"], "middle_residential"] = results.loc[
-        results["main_only"]
-    ].progress_apply(
-        lambda r: tuple(
-            e for e in r["route"][int(r["first"]) : int(r["last"]) + 1] if not e in main_edges
-        ),
-        axis=1,
-    )
-    results["nb_residential"] = results["middle_residential"].apply(lambda x: len(x or []))
-    residential_in_main = set(
-        results.loc[results["nb_residential"] > 0, "middle_residential"].dropna().explode()
-    )
+    # Flag the edges between the first and last main edge of each trip, in the concatenated routes.
+    main_only = results["main_only"].to_numpy()
+    first_pos = offsets[:-1][main_only] + first[main_only].astype(np.int64)
+    last_pos = offsets[:-1][main_only] + last[main_only].astype(np.int64)
+    delta = np.zeros(len(edges_flat) + 1, dtype=np.int64)
+    delta[first_pos] += 1
+    delta[last_pos + 1] -= 1
+    is_residential_flat = (np.cumsum(delta[:-1]) > 0) & ~is_main[edges_flat]
+    cum_residential = np.concatenate(([0], np.cumsum(is_residential_flat)))
+    results["nb_residential"] = cum_residential[offsets[1:]] - cum_residential[offsets[:-1]]
+    residential_in_main = set(np.unique(edges_flat[is_residential_flat]).tolist())
     if residential_in_main:
         print(
             (
@@ -98,41 +130,30 @@ def find_connections(results, edges):
         main_edges = main_edges.union(residential_in_main)
 
         print("Find the first / last main edge again")
-
-        def first_main_index_again(route, prev_first):
-            if np.isnan(prev_first):
-                return first_main_index(route)
-            for i, x in enumerate(route[: int(prev_first)][::-1]):
-                if not x in main_edges:
-                    return prev_first - i
-            else:
-                # All are main.
-                return 0
-
-        def last_main_index_again(route, prev_last):
-            if np.isnan(prev_last):
-                return last_main_index(route)
-            for i, x in enumerate(route[int(prev_last) + 1 :]):
-                if not x in main_edges:
-                    return prev_last + i
-            else:
-                # All are main.
-                return len(route) - 1
-
-        results["first"] = results.progress_apply(
-            lambda r: first_main_index_again(r["route"], r["first"]), axis=1
-        )
-        results["last"] = results.progress_apply(
-            lambda r: last_main_index_again(r["route"], r["last"]), axis=1
-        )
+        is_main[list(residential_in_main)] = True
+        is_main_flat = is_main[edges_flat]
+        start, end = offsets[:-1], offsets[1:]
+        # For the trips not using the main network so far, look for their first / last main edge.
+        has_main = ~np.isnan(first)
+        new_first, new_last = first_last_main(is_main_flat, offsets)
+        first[~has_main] = new_first[~has_main]
+        last[~has_main] = new_last[~has_main]
+        # For the other trips, extend the main part with the main edges adjacent to it, i.e., up to
+        # the previous / next non-main edge.
+        non_main_pos = np.flatnonzero(~is_main_flat)
+        first_pos = start[has_main] + first[has_main].astype(np.int64)
+        last_pos = start[has_main] + last[has_main].astype(np.int64)
+        prev_non_main = np.append(-1, non_main_pos)[np.searchsorted(non_main_pos, first_pos)]
+        next_non_main = np.append(non_main_pos, offsets[-1])[
+            np.searchsorted(non_main_pos, last_pos, side="right")
+        ]
+        first[has_main] = np.maximum(prev_non_main + 1, start[has_main]) - start[has_main]
+        last[has_main] = np.minimum(next_non_main, end[has_main]) - 1 - start[has_main]
+        results["first"] = first
+        results["last"] = last
 
     print("Counting occurences of each edge")
-    counts = defaultdict(lambda: 0)
-    for route in results['route']:
-        for e in route:
-            counts[e] += 1
-    counts = pd.Series(counts)
-    counts.name = 'count'
+    counts = pd.Series(np.bincount(edges_flat, minlength=nb_ids), name="count")
 
     print("Put trips that never use the main network on the side")
     no_main_trips = results.loc[results["first"].isna()].copy()
@@ -142,15 +163,20 @@ def find_connections(results, edges):
     results["first"] = results["first"].astype(int)
     results["last"] = results["last"].astype(int)
 
+    # Position of the routes' start, end, first main edge and last main edge in the concatenated
+    # routes.
+    start = results["start"].to_numpy()
+    end = results["end"].to_numpy()
+    first_pos = start + results["first"].to_numpy()
+    last_pos = start + results["last"].to_numpy()
+
     if residential_in_main:
         print("Finding main edges remaining in the access / egress part")
-        results["nb_main_in_access"] = results.progress_apply(
-            lambda r: sum(1 for e in r["route"][: r["first"]] if e in residential_in_main), axis=1
-        )
-        results["nb_main_in_egress"] = results.progress_apply(
-            lambda r: sum(1 for e in r["route"][r["last"] + 1 :] if e in residential_in_main),
-            axis=1,
-        )
+        is_residential_in_main = np.zeros(nb_ids, dtype=bool)
+        is_residential_in_main[list(residential_in_main)] = True
+        cum_count = np.concatenate(([0], np.cumsum(is_residential_in_main[edges_flat])))
+        results["nb_main_in_access"] = cum_count[first_pos] - cum_count[start]
+        results["nb_main_in_egress"] = cum_count[end] - cum_count[last_pos + 1]
         nb_trips = np.sum((results["nb_main_in_access"] > 0) | (results["nb_main_in_egress"] > 0))
         nb_in_access = results["nb_main_in_access"].sum()
         nb_in_egress = results["nb_main_in_egress"].sum()
@@ -163,23 +189,20 @@ def find_connections(results, edges):
             )
 
     print("Find the access / egress edges")
-    results["O_edge"] = results.progress_apply(lambda r: r["route"][r["first"]], axis=1)
-    results["D_edge"] = results.progress_apply(lambda r: r["route"][r["last"]], axis=1)
+    results["O_edge"] = edges_flat[first_pos]
+    results["D_edge"] = edges_flat[last_pos]
 
     print("Find the access / egress nodes")
-    results["O_node"] = results["O_edge"].progress_apply(lambda e: edge_source[e])
-    results["D_node"] = results["D_edge"].progress_apply(lambda e: edge_target[e])
+    results["O_node"] = edge_source[edges_flat[first_pos]]
+    results["D_node"] = edge_target[edges_flat[last_pos]]
 
     print("Number of unique origins: {}".format(results["O_node"].nunique()))
     print("Number of unique destinations: {}".format(results["D_node"].nunique()))
 
     print("Compute access / egress times")
-    results["access_time"] = results.progress_apply(
-        lambda r: sum(edge_time[e] for e in r["route"][: r["first"]]), axis=1
-    )
-    results["egress_time"] = results.progress_apply(
-        lambda r: sum(edge_time[e] for e in r["route"][r["last"] + 1 :]), axis=1
-    )
+    cum_time = np.concatenate(([0.0], np.cumsum(edge_time[edges_flat])))
+    results["access_time"] = cum_time[first_pos] - cum_time[start]
+    results["egress_time"] = cum_time[end] - cum_time[last_pos + 1]
 
     return main_edges, results, no_main_trips, counts
 
@@ -208,8 +231,10 @@ def merge(trips, main_trips, no_main_trips):
 
     main_trips = main_trips[
         ["trip_id", "travel_time", "road_leg", "O_node", "D_node", "access_time", "egress_time"]
-    ].copy()
-    no_main_trips = no_main_trips[["trip_id", "travel_time", "road_leg"]].copy()
+    ].astype({"trip_id": np.int32, "O_node": np.int32, "D_node": np.int32})
+    no_main_trips = no_main_trips[["trip_id", "travel_time", "road_leg"]].astype(
+        {"trip_id": np.int32}
+    )
 
     trips_connect = pd.concat((main_trips, no_main_trips))
 
@@ -231,18 +256,17 @@ def is_strongly_connected(edges):
     n = len(set(edges["source"]).union(set(edges["target"])))
     if n != nb_sources:
         return False
-    G = nx.DiGraph()
-    G.add_edges_from(
-        map(
-            lambda keyrow: (keyrow[1]["source"], keyrow[1]["target"]),
-            edges[["source", "target"]].iterrows(),
-        )
+    # Encode the node ids as 0..n-1 and build the adjacency matrix of the graph.
+    nodes, inv = np.unique(
+        np.concatenate((edges["source"].to_numpy(), edges["target"].to_numpy())),
+        return_inverse=True,
     )
-    # Find the nodes of the largest strongly connected component.
-    connected_nodes = max(nx.strongly_connected_components(G), key=len)
-    if len(connected_nodes) < n:
-        return False
-    return True
+    sources, targets = inv[: len(edges)], inv[len(edges) :]
+    graph = csr_matrix(
+        (np.ones(len(edges), dtype=bool), (sources, targets)), shape=(len(nodes), len(nodes))
+    )
+    nb_components = connected_components(graph, connection="strong", return_labels=False)
+    return nb_components == 1
 
 
 if __name__ == "__main__":
@@ -251,9 +275,11 @@ if __name__ == "__main__":
 
     edges = read_edges()
 
-    results = load_results()
+    results, edges_flat, offsets = load_results()
 
-    main_edges, main_trips, no_main_trips, counts = find_connections(results, edges)
+    main_edges, main_trips, no_main_trips, counts = find_connections(
+        results, edges_flat, offsets, edges
+    )
 
     edges = process_edges(edges, main_edges, counts)
 
@@ -264,12 +290,15 @@ if __name__ == "__main__":
         print("Error: The graph is not strongly connected")
 
     print("Saving the edges")
-    edges.to_file(EDGE_FILE, driver='FlatGeobuf')
+    edges.to_file(EDGE_FILE, driver="FlatGeobuf", engine="pyogrio")
+    edges.drop(columns="geometry").reset_index().to_parquet(
+        EDGE_ATTRS_FILE, index=False, compression="zstd"
+    )
 
     trips = merge(trips, main_trips, no_main_trips)
 
     print("Saving the trips")
-    trips.to_csv(TRIPS_FILE, index=False)
+    trips.to_parquet(TRIPS_FILE, index=False, compression="zstd")
 
     t = time.time() - t0
     print("Total running time: {:.2f} seconds".format(t))
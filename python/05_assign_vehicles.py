@@ -3,7 +3,7 @@ import pandas as pd
 import geopandas as gpd
 
 # Path to the file where the trips to simulate are stored.
-TRIP_FILE = "./output/trips/trips.csv"
+TRIP_FILE = "./output/trips/trips.parquet"
 # Path to the file where the Commune-level vehicles types are stored.
 VEHICLE_FILE = "./data/parc/Parc_VP_Communes_2021.xlsx"
 # Path to the file with the Commune geometries.
@@ -12,6 +12,8 @@ COMMUNE_FILE = "./data/contours_communes/communes-20210101.shp"
 INVALID_CRITAIRS = ("Crit'air 4", "Crit'air 5", "Inconnu", "Non classée")
 # CRS to use for metric operations.
 METRIC_CRS = "EPSG:2154"
+# Number of homes joined to the communes at once (limits the memory usage of the spatial join).
+CHUNK_SIZE = 100_000
 
 # Path to the file where the output communes FlatGeobuf with invalid shares should be stored.
 OUTPUT_COMMUNE = "./output/communes_invalid_share.fgb"
@@ -19,10 +21,10 @@ OUTPUT_COMMUNE = "./output/communes_invalid_share.fgb"
 print("Reading vehicles...")
 vehicles = pd.read_excel(VEHICLE_FILE)
 vehicles = vehicles.dropna()
-# Select Île-de-France région.
-vehicles = vehicles.loc[vehicles["Code région"] == "11"].copy()
-# Drop "Inconnu".
-vehicles = vehicles.loc[vehicles["Vignette Crit'air"] != "Inconnu"].copy()
+# Select Île-de-France région and drop "Inconnu".
+vehicles = vehicles.loc[
+    (vehicles["Code région"] == "11") & (vehicles["Vignette Crit'air"] != "Inconnu")
+].copy()
 
 vehicles["invalid"] = vehicles["Vignette Crit'air"].isin(INVALID_CRITAIRS)
 vehicles["invalid_count"] = vehicles["invalid"] * vehicles["Parc au 01/01/2021"]
@@ -36,37 +38,52 @@ invalid_share = (
 invalid_share.name = "invalid_share"
 
 print("Reading communes...")
-communes = gpd.read_file(COMMUNE_FILE)
+communes = gpd.read_file(COMMUNE_FILE, engine="pyogrio", use_arrow=True)
 communes.drop(columns=["wikipedia", "surf_ha"], inplace=True)
 communes.to_crs(METRIC_CRS, inplace=True)
 
 # Save a FlatGeobuf with the communes geometries and the invalid share.
 gdf = communes.merge(invalid_share, left_on="insee", right_index=True, how="right")
-gdf.to_file(OUTPUT_COMMUNE, driver="FlatGeobuf")
+gdf.to_file(OUTPUT_COMMUNE, driver="FlatGeobuf", engine="pyogrio")
 
 print("Reading trips...")
-trips = pd.read_csv(TRIP_FILE)
+trips = pd.read_parquet(TRIP_FILE)
 trips.sort_values(["person_id", "trip_index"], inplace=True)
 
 print("Finding INSEE commune of origin...")
-homes = trips.groupby("person_id")[["x0", "y0"]].first().reset_index()
-homes = gpd.GeoDataFrame(homes, geometry=gpd.GeoSeries.from_xy(homes['x0'], homes['y0']))
-homes.set_crs(METRIC_CRS, inplace=True)
-homes = homes.sjoin(communes, how='left', predicate='within')
-homes = homes.groupby('person_id')['insee'].first().reset_index()
-
-homes["critair"] = None
+# The trips are sorted so the first trip of each person starts from home.
+homes = trips.drop_duplicates("person_id", keep="first")[["person_id", "x0", "y0"]]
+points = gpd.points_from_xy(homes["x0"], homes["y0"], crs=METRIC_CRS)
+# Index of the commune of each home (-1 if the home is in no commune).
+commune_idx = np.full(len(homes), -1, dtype=np.int64)
+for i in range(0, len(homes), CHUNK_SIZE):
+    home_idx, tree_idx = communes.sindex.query(points[i : i + CHUNK_SIZE], predicate="within")
+    # A point can be in several communes if their geometries overlap: keep the first one.
+    home_idx, first = np.unique(home_idx, return_index=True)
+    commune_idx[i + home_idx] = tree_idx[first]
+homes = homes[["person_id"]].copy()
+homes["insee"] = communes["insee"].to_numpy()[commune_idx]
+homes.loc[commune_idx < 0, "insee"] = np.nan
 
 print("Drawing vehicles...")
-for insee_code, idx in homes.groupby("insee").groups.items():
-    persons = homes.loc[idx]
-    vehicle_pool = vehicles.loc[
-        vehicles["Code commune"] == insee_code, ["Vignette Crit'air", "Parc au 01/01/2021"]
-    ]
-    probs = vehicle_pool["Parc au 01/01/2021"] / vehicle_pool["Parc au 01/01/2021"].sum()
-    draws = np.random.choice(vehicle_pool["Vignette Crit'air"], size=len(persons), p=probs)
-    homes.loc[idx, "critair"] = draws
+# Number of vehicles for each commune (rows) and each Crit'air label (columns).
+pool = vehicles.pivot_table(
+    index="Code commune",
+    columns="Vignette Crit'air",
+    values="Parc au 01/01/2021",
+    aggfunc="sum",
+    fill_value=0,
+)
+cumprobs = pool.to_numpy(dtype=np.float64).cumsum(axis=1)
+cumprobs /= cumprobs[:, -1:]
+# Index of the commune of each person in the pool (-1 if the commune has no vehicle).
+k = pool.index.get_indexer(homes["insee"])
+has_pool = k >= 0
+codes = np.full(len(homes), -1, dtype=np.int64)
+u = np.random.default_rng().random(has_pool.sum())
+codes[has_pool] = (u[:, np.newaxis] < cumprobs[k[has_pool]]).argmax(axis=1)
+homes["critair"] = pd.Categorical.from_codes(codes, categories=pool.columns)
 
 print("Writing trips...")
 trips = trips.merge(homes[['person_id', 'critair']], on='person_id', how='left')
-trips.to_csv(TRIP_FILE, index=False)
+trips.to_parquet(TRIP_FILE, index=False, compression="zstd")
@@ -1,4 +1,6 @@
+import numpy as np
 import geopandas as gpd
+import shapely
 from shapely.geometry import Polygon
 
 # Path to the file where the A86 geometry is stored.
@@ -10,11 +12,13 @@ ZFE_FILE = "./output/ZFE/zfe.geojson"
 # Path to the file where the edges are stored.
 EDGES_FILE = "./output/osm_network/osm_edges.fgb"
 EDGES_DRIVER = "FlatGeobuf"
+# Path to the Parquet file where the edges attributes (without geometry) are stored.
+EDGES_ATTRS_FILE = "./output/osm_network/osm_edges_attrs.parquet"
 
 print("Creating ZFE boundaries...")
 # Read the A86 and MGP as Polygons.
-a86 = gpd.read_file(A86_FILE).to_crs("epsg:2154")
-mgp = gpd.read_file(MGP_FILE).to_crs("epsg:2154")
+a86 = gpd.read_file(A86_FILE, engine="pyogrio", use_arrow=True).to_crs("epsg:2154")
+mgp = gpd.read_file(MGP_FILE, engine="pyogrio", use_arrow=True).to_crs("epsg:2154")
 
 a86 = Polygon(a86.iloc[0]["geometry"])
 mgp = Polygon(mgp.iloc[0]["geometry"])
@@ -27,18 +31,23 @@ zfe = a86 & mgp
 
 s = gpd.GeoSeries(zfe)
 s.name = "ZFE"
-s.to_file(ZFE_FILE, driver="GeoJSON")
+s.to_file(ZFE_FILE, driver="GeoJSON", engine="pyogrio")
 
 # Read edges.
 print("Reading edges...")
-edges = gpd.read_file(EDGES_FILE, driver=EDGES_DRIVER).to_crs("epsg:2154")
+edges = gpd.read_file(EDGES_FILE, engine="pyogrio", use_arrow=True).to_crs("epsg:2154")
 
 # Mark edges in the ZFE.
 print("Finding edges inside the ZFE...")
-edges["zfe"] = edges.geometry.within(zfe)
+# Query the edges whose geometry is within the ZFE (i.e., the ZFE contains the edge).
+tree = shapely.STRtree(edges.geometry.values)
+inside = np.zeros(len(edges), dtype=bool)
+inside[tree.query(zfe, predicate="contains")] = True
+edges["zfe"] = inside
 
 n = edges["zfe"].sum()
 print("{} edges in the ZFE (representing {:.2%} of edges)".format(n, n / len(edges)))
 
 print("Writing edges...")
-edges.to_file(EDGES_FILE, driver=EDGES_DRIVER)
+edges.to_file(EDGES_FILE, driver=EDGES_DRIVER, engine="pyogrio")
+edges.drop(columns="geometry").to_parquet(EDGES_ATTRS_FILE, index=False, compression="zstd")
@@ -1,20 +1,18 @@
 import os
 import time
-import json
 import subprocess
 
+import numpy as np
+import orjson
 import pandas as pd
-import geopandas as gpd
 
 # Path to the files where the trips are stored.
-TRIPS_FILE = "./output/trips/trips.csv"
+TRIPS_FILE = "./output/trips/trips.parquet"
 # Crit'air labels which are forbidden in the ZFE.
 INVALID_CRITAIRS = ("Crit'air 4", "Crit'air 5", "Inconnu", "Non classée")
 
-# Path to the FlatGeobuf file where edges are stored.
-EDGE_FILE = "./output/osm_network/osm_edges.fgb"
-# CRS to use for metric operations.
-METRIC_CRS = "EPSG:2154"
+# Path to the Parquet file where the edges attributes (without geometry) are stored.
+EDGE_FILE = "./output/osm_network/osm_edges_attrs.parquet"
 
 # Directory where temporary files for the routing script should be stored.
 ROUTING_DIR = "./output/routing/"
@@ -29,16 +27,26 @@ PARAMETERS = {
 
 def read_trips():
     print("Reading trips")
-    trips = pd.read_csv(TRIPS_FILE)
+    trips = pd.read_parquet(TRIPS_FILE)
     print("{} trips read".format(len(trips)))
     return trips
 
 
+def is_polluting(trips):
+    """Returns a boolean array flagging the trips whose vehicle has an invalid Crit'air."""
+    critair = trips["critair"].astype("category").cat
+    invalid_codes = critair.categories.get_indexer(INVALID_CRITAIRS)
+    return np.isin(critair.codes.to_numpy(), invalid_codes[invalid_codes >= 0])
+
+
 def read_edges():
     print("Reading edges")
-    edges = gpd.read_file(EDGE_FILE)
-    # Select main edges, not in the ZFE.
-    edges = edges.loc[edges["main"] & (~edges["zfe"])].copy()
+    # Read main edges, not in the ZFE.
+    edges = pd.read_parquet(
+        EDGE_FILE,
+        columns=["source", "target", "length", "speed", "index_main"],
+        filters=[("main", "==", True), ("zfe", "==", False)],
+    )
     edges.sort_values("index_main", inplace=True)
     # Computes edges' travel time in seconds.
     # `length` is in meters and `speed` is in km/h
@@ -49,30 +57,28 @@ def read_edges():
 def prepare_shortestpath(trips, edges):
     print("Creating queries")
     # Select trips with an invalid vehicle.
-    polluting_trips = trips.loc[trips["critair"].isin(INVALID_CRITAIRS)].copy()
-    polluting_trips = polluting_trips.loc[polluting_trips['road_leg']].copy()
+    polluting_trips = trips.loc[
+        is_polluting(trips) & trips["road_leg"], ["trip_id", "O_node", "D_node"]
+    ].astype(int)
     polluting_trips["departure_time"] = 0.0
-    polluting_trips["O_node"] = polluting_trips["O_node"].astype(int)
-    polluting_trips["D_node"] = polluting_trips["D_node"].astype(int)
-    columns = ["trip_id", "O_node", "D_node", "departure_time"]
-    queries = [*map(tuple, zip(*map(polluting_trips.get, columns)))]
+    queries = polluting_trips.to_records(index=False).tolist()
 
     print("Creating Graph")
     columns = ["source", "target", "tt"]
-    graph = [*map(tuple, zip(*map(edges.get, columns)))]
+    graph = edges[columns].to_records(index=False).tolist()
 
     print("Writing data...")
     if not os.path.isdir(ROUTING_DIR):
         os.makedirs(ROUTING_DIR)
     print("Queries")
-    with open(os.path.join(ROUTING_DIR, "queries.json"), "w") as f:
-        json.dump(queries, f)
+    with open(os.path.join(ROUTING_DIR, "queries.json"), "wb") as f:
+        f.write(orjson.dumps(queries))
     print("Graph")
-    with open(os.path.join(ROUTING_DIR, "graph.json"), "w") as f:
-        json.dump(graph, f)
+    with open(os.path.join(ROUTING_DIR, "graph.json"), "wb") as f:
+        f.write(orjson.dumps(graph))
     print("Parameters")
-    with open(os.path.join(ROUTING_DIR, "parameters.json"), "w") as f:
-        json.dump(PARAMETERS, f)
+    with open(os.path.join(ROUTING_DIR, "parameters.json"), "wb") as f:
+        f.write(orjson.dumps(PARAMETERS))
 
     print("Done!")
 
@@ -101,8 +107,8 @@ def run_shortestpath():
 
 def load_results():
     print("Reading routing results")
-    with open(os.path.join(ROUTING_DIR, "output.json"), "r") as f:
-        data = json.load(f)
+    with open(os.path.join(ROUTING_DIR, "output.json"), "rb") as f:
+        data = orjson.loads(f.read())
     df = pd.DataFrame(list(filter(None, data["results"])), columns=["trip_id", "travel_time"])
     print("{} trips are not feasible".format(len(data['results']) - len(df)))
     return df
@@ -123,11 +129,11 @@ if __name__ == "__main__":
     results = load_results()
 
     trips['is_feasible'] = True
-    trips.loc[trips['road_leg'] & trips['critair'].isin(INVALID_CRITAIRS), 'is_feasible'] = False
+    trips.loc[trips['road_leg'] & is_polluting(trips), 'is_feasible'] = False
     trips.loc[trips['trip_id'].isin(results['trip_id']), 'is_feasible'] = True
 
     print("Writing trips...")
-    trips.to_csv(TRIPS_FILE, index=False)
+    trips.to_parquet(TRIPS_FILE, index=False, compression="zstd")
 
     t = time.time() - t0
     print("Total running time: {:.2f} seconds".format(t))
@@ -1,15 +1,15 @@
 import os
 import time
-import json
 
 import numpy as np
+import orjson
 import pandas as pd
 import geopandas as gpd
 
 # Path to the FlatGeobuf file where edges are stored.
 EDGE_FILE = "./output/osm_network/osm_edges.fgb"
 # Path to the file where the trip data is stored.
-TRIPS_FILE = "./output/trips/trips.csv"
+TRIPS_FILE = "./output/trips/trips.parquet"
 # Use only trips whose mode is within the following modes
 # (available values: car, car_passenger, pt, walk, bike).
 MODES = ("car",)
@@ -40,7 +40,7 @@ DT_MU = 3.0
 # Width of the departure-time choice intervals (for DEPARTURE_TIME_MODEL "Discrete" only).
 DT_WIDTH = 5.0 * 60.0
 # Bins of the departure-time choice intervals (for DEPARTURE_TIME_MODEL "Discrete" only).
-DT_BINS = list(np.arange(PERIOD[0] + DT_WIDTH / 2, PERIOD[1], DT_WIDTH))
+DT_BINS = np.arange(PERIOD[0] + DT_WIDTH / 2, PERIOD[1], DT_WIDTH).tolist()
 # How t* is computed given the observed arrival time.
 def T_STAR_FUNC(ta):
     return ta
@@ -86,51 +86,96 @@ PARAMETERS = {
 
 def read_edges():
     print("Reading edges")
-    edges = gpd.read_file(EDGE_FILE)
-    edges = edges.loc[edges["main"]].copy()
-    edges.sort_values("index_main", inplace=True)
-    return edges
+    edges = gpd.read_file(
+        EDGE_FILE,
+        engine="pyogrio",
+        use_arrow=True,
+        columns=[
+            "source",
+            "target",
+            "index_main",
+            "speed",
+            "length",
+            "lanes",
+            "capacity",
+            "main",
+            "zfe",
+        ],
+        # The `where` column must be read for the filter to apply on FlatGeobuf files.
+        where="main = 1",
+        read_geometry=False,
+    )
+    # The main edges are indexed from 0 to n-1 so they can be put in order without sorting.
+    order = np.empty(len(edges), dtype=np.int64)
+    order[edges["index_main"].to_numpy()] = np.arange(len(edges))
+    return edges.iloc[order]
 
 
 def read_trips():
     print("Reading trips")
-    trips = pd.read_csv(TRIPS_FILE)
-    trips = trips.loc[trips["mode"].isin(MODES)].copy()
-    trips = trips.loc[
-        (trips["departure_time"] >= PERIOD[0]) & (trips["arrival_time"] <= PERIOD[1])
-    ].copy()
+    columns = [
+        "person_id",
+        "trip_index",
+        "departure_time",
+        "arrival_time",
+        "travel_time",
+        "road_leg",
+        "O_node",
+        "D_node",
+        "origin_delay",
+        "destination_delay",
+    ]
+    if ZFE:
+        columns += ["critair", "is_feasible"]
+    trips = pd.read_parquet(
+        TRIPS_FILE,
+        columns=columns,
+        filters=[
+            ("mode", "in", list(MODES)),
+            ("departure_time", ">=", PERIOD[0]),
+            ("arrival_time", "<=", PERIOD[1]),
+        ],
+    )
     print("{} trips read".format(len(trips)))
     return trips
 
 
-def generate_road_network(edges):
-    print("Creating Metropolis road network")
-    metro_edges = list()
-    for _, row in edges.iterrows():
+def generate_edges(edges):
+    """Yields the Metropolis edges, one at a time."""
+    columns = zip(
+        edges["source"].tolist(),
+        edges["target"].tolist(),
+        edges["index_main"].to_numpy(np.int64).tolist(),
+        (edges["speed"].to_numpy(np.float64) / 3.6).tolist(),
+        edges["length"].to_numpy(np.float64).tolist(),
+        edges["lanes"].to_numpy(np.int64).tolist(),
+        (edges["capacity"].to_numpy(np.float64) / 3600.0).tolist(),
+    )
+    # The speed-density function is the same for all the edges.
+    speed_density = {
+        "type": "FreeFlow",
+    }
+    for source, target, index, speed, length, lanes, flow in columns:
         edge = [
-            row["source"],
-            row["target"],
+            source,
+            target,
             {
-                "id": int(row["index_main"]),
-                "base_speed": float(row["speed"]) / 3.6,
-                "length": float(row["length"]),
-                "lanes": int(row["lanes"]),
-                "speed_density": {
-                    "type": "FreeFlow",
-                },
+                "id": index,
+                "base_speed": speed,
+                "length": length,
+                "lanes": lanes,
+                "speed_density": speed_density,
                 "overtaking": True,
             },
         ]
-        if capacity := row["capacity"]:
-            edge[2]["bottleneck_flow"] = capacity / 3600.0
+        if flow > 0:
+            edge[2]["bottleneck_flow"] = flow
         #  if const_tt := CONST_TT.get(row["neighbor_count"]):
         #  edge[2]["constant_travel_time"] = const_tt
-        metro_edges.append(edge)
+        yield edge
 
-    graph = {
-        "edges": metro_edges,
-    }
 
+def generate_vehicles(edges):
     vehicles = [
         {
             "length": VEHICLE_LENGTH,
@@ -154,81 +199,105 @@ def generate_road_network(edges):
                 "restricted_edges": zfe_edges,
             }
         )
+    return vehicles
 
-    road_network = {
-        "graph": graph,
-        "vehicles": vehicles,
-    }
-    return road_network
+
+def write_road_network(edges, f):
+    """Writes the Metropolis road network as JSON to the binary file `f`, without building the
+    list of all the edges in memory."""
+    print("Creating Metropolis road network")
+    f.write(b'{"graph":{"edges":[')
+    for i, edge in enumerate(generate_edges(edges)):
+        if i > 0:
+            f.write(b",")
+        f.write(orjson.dumps(edge))
+    f.write(b']},"vehicles":')
+    f.write(orjson.dumps(generate_vehicles(edges)))
+    f.write(b"}")
 
 
 def generate_agents(trips):
     trips.sort_values(["person_id", "trip_index"], inplace=True)
-    trips["is_first"] = trips["trip_id"].isin(trips.groupby("person_id")["trip_id"].first())
-    trips["is_last"] = trips["trip_id"].isin(trips.groupby("person_id")["trip_id"].last())
+    person_ids = trips["person_id"].to_numpy()
+    trips["is_first"] = np.r_[True, person_ids[1:] != person_ids[:-1]]
+    trips["is_last"] = np.r_[person_ids[:-1] != person_ids[1:], True]
     # Fill values for virtual legs.
     trips["origin_delay"] = trips["origin_delay"].fillna(0)
     trips["destination_delay"] = trips["destination_delay"].fillna(0)
-    # Compute stopping times.
-    trips["next_departure_time"] = trips["departure_time"].shift(-1, fill_value=0)
-    trips["stopping_time"] = trips["next_departure_time"] - trips["arrival_time"]
-    trips.loc[trips["is_last"], "stopping_time"] = 0
-    trips["next_origin_delay"] = trips["origin_delay"].shift(-1, fill_value=0)
-    trips.loc[trips["is_last"], "next_origin_delay"] = 0
+    # Compute stopping times (zero after the last trip of each person).
+    is_last = trips["is_last"].to_numpy()
+    next_departure_time = np.append(trips["departure_time"].to_numpy()[1:], 0.0)
+    trips["stopping_time"] = np.where(
+        is_last, 0.0, next_departure_time - trips["arrival_time"].to_numpy()
+    )
+    next_origin_delay = np.append(trips["origin_delay"].to_numpy()[1:], 0.0)
+    trips["next_origin_delay"] = np.where(is_last, 0.0, next_origin_delay)
     print("Generating agents")
-    random_u = iter(RNG.uniform(size=len(trips)))
     agents = list()
     nb_persons = trips["person_id"].nunique()
+    # Draw the random values of all the agents at once.
+    random_u = RNG.uniform(size=nb_persons).tolist()
+    if DEPARTURE_TIME_MODEL == "Discrete":
+        gumbels = RNG.gumbel(scale=DT_MU, size=(nb_persons, len(DT_BINS))).tolist()
+        dt_offsets = RNG.uniform(-DT_WIDTH / 2, DT_WIDTH / 2, size=nb_persons).tolist()
     origins = set()
     destinations = set()
-    for i, (person_id, idx) in enumerate(trips.groupby("person_id").groups.items()):
-        legs = list()
-        for _, trip in trips.loc[idx].iterrows():
-            print(f"person_id : {i + 1}/{nb_persons}", end="\r")
-
-            t_star = T_STAR_FUNC(trip["arrival_time"]) - trip["destination_delay"]
-
-            if trip["road_leg"]:
-                origin = int(trip["O_node"])
-                destination = int(trip["D_node"])
-                origins.add(origin)
-                destinations.add(destination)
-                if ZFE and trip["is_feasible"] and trip["critair"] in INVALID_CRITAIRS:
-                    vehicle_id = 1
-                else:
-                    vehicle_id = 0
-                leg = {
-                    "class": {
-                        "type": "Road",
-                        "value": {
-                            "origin": origin,
-                            "destination": destination,
-                            "vehicle": vehicle_id,
-                        },
-                    }
-                }
-                leg["travel_utility"] = {
-                    "type": "Polynomial",
-                    "value": {
-                        "b": -ALPHA / 3600.0,
-                    },
-                }
-                leg["schedule_utility"] = {
-                    "type": "AlphaBetaGamma",
+    travel_utility = {
+        "type": "Polynomial",
+        "value": {
+            "b": -ALPHA / 3600.0,
+        },
+    }
+    # The trips are sorted by person so the legs of a person are consecutive.
+    for trip in trips.itertuples(index=False):
+        if trip.is_first:
+            legs = list()
+            first_trip = trip
+
+        t_star = T_STAR_FUNC(trip.arrival_time) - trip.destination_delay
+
+        if trip.road_leg:
+            origin = int(trip.O_node)
+            destination = int(trip.D_node)
+            origins.add(origin)
+            destinations.add(destination)
+            if ZFE and trip.is_feasible and trip.critair in INVALID_CRITAIRS:
+                vehicle_id = 1
+            else:
+                vehicle_id = 0
+            leg = {
+                "class": {
+                    "type": "Road",
                     "value": {
-                        "beta": BETA / 3600.0,
-                        "gamma": GAMMA / 3600.0,
-                        "t_star_high": t_star + DELTA / 2.0,
-                        "t_star_low": t_star - DELTA / 2.0,
+                        "origin": origin,
+                        "destination": destination,
+                        "vehicle": vehicle_id,
                     },
                 }
-                leg["stopping_time"] = (
-                    trip["destination_delay"] + trip["stopping_time"] + trip["next_origin_delay"]
-                )
-            else:
-                leg = {"class": {"type": "Virtual", "value": trip["travel_time"]}}
-                leg["stopping_time"] = trip["stopping_time"] + trip["next_origin_delay"]
-            legs.append(leg)
+            }
+            leg["travel_utility"] = travel_utility
+            leg["schedule_utility"] = {
+                "type": "AlphaBetaGamma",
+                "value": {
+                    "beta": BETA / 3600.0,
+                    "gamma": GAMMA / 3600.0,
+                    "t_star_high": t_star + DELTA / 2.0,
+                    "t_star_low": t_star - DELTA / 2.0,
+                },
+            }
+            leg["stopping_time"] = (
+                trip.destination_delay + trip.stopping_time + trip.next_origin_delay
+            )
+        else:
+            leg = {"class": {"type": "Virtual", "value": trip.travel_time}}
+            leg["stopping_time"] = trip.stopping_time + trip.next_origin_delay
+        legs.append(leg)
+
+        if not trip.is_last:
+            continue
+
+        i = len(agents)
+        print(f"person_id : {i + 1}/{nb_persons}", end="\r")
         if DEPARTURE_TIME_MODEL == "Continuous":
             departure_time_model = {
                 "type": "ContinuousChoice",
@@ -237,7 +306,7 @@ def generate_agents(trips):
                     "choice_model": {
                         "type": "Logit",
                         "value": {
-                            "u": next(random_u),
+                            "u": random_u[i],
                             "mu": DT_MU,
                         },
                     },
@@ -251,28 +320,28 @@ def generate_agents(trips):
                     "choice_model": {
                         "type": "Deterministic",
                         "value": {
-                            "u": RNG.uniform(),
-                            "constants": list(RNG.gumbel(scale=DT_MU, size=len(DT_BINS))),
+                            "u": random_u[i],
+                            "constants": gumbels[i],
                         },
                     },
-                    "offset": RNG.uniform(-DT_WIDTH / 2, DT_WIDTH / 2),
+                    "offset": dt_offsets[i],
                 },
             }
         else:
             departure_time_model = {
                 "type": "Constant",
-                "value": trips.loc[idx[0], "departure_time"],
+                "value": first_trip.departure_time,
             }
         car_mode = {
             "type": "Trip",
             "value": {
                 "legs": legs,
-                "origin_delay": trips.loc[idx[0], "origin_delay"],
+                "origin_delay": first_trip.origin_delay,
                 "departure_time_model": departure_time_model,
             },
         }
         agent = {
-            "id": person_id,
+            "id": trip.person_id,
             "modes": [car_mode],
         }
         agents.append(agent)
@@ -294,8 +363,8 @@ if __name__ == "__main__":
         os.makedirs(OUTPUT_DIR)
 
     print("Writing parameters")
-    with open(os.path.join(OUTPUT_DIR, "parameters.json"), "w") as f:
-        f.write(json.dumps(PARAMETERS))
+    with open(os.path.join(OUTPUT_DIR, "parameters.json"), "wb") as f:
+        f.write(orjson.dumps(PARAMETERS))
 
     edges = read_edges()
 
@@ -305,16 +374,14 @@ if __name__ == "__main__":
     del trips
 
     print("Writing agents")
-    with open(os.path.join(OUTPUT_DIR, "agents.json"), "w") as f:
-        f.write(json.dumps(agents))
+    with open(os.path.join(OUTPUT_DIR, "agents.json"), "wb") as f:
+        f.write(orjson.dumps(agents))
     del agents
 
-    road_network = generate_road_network(edges)
-    del edges
-
     print("Writing road network")
-    with open(os.path.join(OUTPUT_DIR, "network.json"), "w") as f:
-        f.write(json.dumps(road_network))
+    with open(os.path.join(OUTPUT_DIR, "network.json"), "wb") as f:
+        write_road_network(edges, f)
+    del edges
 
     t = time.time() - t0
     print("Total running time: {:.2f} seconds".format(t))
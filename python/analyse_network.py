@@ -7,7 +7,12 @@ EDGE_FILENAME = "../MetropolisIDF/output/here_network/edges.fgb"
 
 
 def get_edges():
-    edges = gpd.read_file(EDGE_FILENAME)
+    edges = gpd.read_file(
+        EDGE_FILENAME,
+        engine="pyogrio",
+        use_arrow=True,
+        columns=["length", "speed", "lanes", "capacity", "road_type", "main"],
+    )
     return edges
 
 
@@ -91,7 +96,7 @@ def plot_road_type_chart(edges, mask=None):
         12: "Unclassified",
         13: "Residential",
     }
-    edges["road_type_name"] = edges["road_type"].apply(lambda rt: names[rt])
+    edges["road_type_name"] = edges["road_type"].map(names)
     road_types = edges.loc[mask].groupby("road_type_name")["length"].sum() / 1000
     # Sort index.
     road_types = road_types[
@@ -1,6 +1,7 @@
-import json
-
+import numpy as np
 import geopandas as gpd
+import orjson
+import shapely
 import folium
 from folium.vector_layers import Circle, PolyLine
 from matplotlib import colormaps
@@ -16,13 +17,14 @@ EDGE_FILENAME = "../MetropolisIDF/output/here_network/edges.fgb"
 def get_agent_results():
     dctx = zstd.ZstdDecompressor()
     with open(AGENT_RESULTS_FILENAME, "br") as f:
-        reader = dctx.stream_reader(f)
-        data = json.load(reader)
+        data = orjson.loads(dctx.stream_reader(f).read())
     return data
 
 
 def get_edges():
-    edges = gpd.read_file(EDGE_FILENAME)
+    edges = gpd.read_file(
+        EDGE_FILENAME, engine="pyogrio", use_arrow=True, columns=["length", "speed"]
+    )
     return edges
 
 
@@ -35,10 +37,10 @@ def get_agent_map(agent, edges):
         legs.append({"arrival_time": leg["arrival_time"], "route": leg["class"]["value"]["route"]})
 
     edges_taken_set = {e[0] for leg in legs for e in leg["route"]}
-    edges_taken = edges.loc[list(edges_taken_set)]
+    edges_taken = edges.loc[list(edges_taken_set)].to_crs("epsg:4326")
 
-    centroids = edges_taken.centroid.to_crs("epsg:4326")
-    mean_location = [centroids.y.mean(), centroids.x.mean()]
+    centroids = shapely.centroid(edges_taken.geometry.values)
+    mean_location = [shapely.get_y(centroids).mean(), shapely.get_x(centroids).mean()]
 
     m = folium.Map(
         location=mean_location,
@@ -47,14 +49,18 @@ def get_agent_map(agent, edges):
         attr='\u003ca href="https://www.maptiler.com/copyright/" target="_blank"\u003e\u0026copy; MapTiler\u003c/a\u003e \u003ca href="https://www.openstreetmap.org/copyright" target="_blank"\u003e\u0026copy; OpenStreetMap contributors\u003c/a\u003e',
     )
 
-    edges_taken.to_crs("epsg:4326", inplace=True)
-    edges_taken["fftt"] = edges_taken["length"] / (edges_taken["speed"] / 3.6)
+    # Coordinates (as latitude / longitude) and free-flow travel time of the edges taken.
+    edge_coords = {
+        idx: [p[::-1] for p in geom.coords]
+        for idx, geom in zip(edges_taken.index, edges_taken.geometry)
+    }
+    edge_fftt = (edges_taken["length"] / (edges_taken["speed"] / 3.6)).to_dict()
 
     colormap = colormaps["RdYlGn"]
 
     for leg in legs:
-        origin_coords = edges_taken.loc[leg["route"][0][0], "geometry"].coords[0][::-1]
-        destination_coords = edges_taken.loc[leg["route"][-1][0], "geometry"].coords[-1][::-1]
+        origin_coords = edge_coords[leg["route"][0][0]][0]
+        destination_coords = edge_coords[leg["route"][-1][0]][-1]
         Circle(
             location=origin_coords,
             radius=30,
@@ -74,25 +80,27 @@ def get_agent_map(agent, edges):
             fill_color="#E52424",
         ).add_to(m)
 
-        for i in range(len(leg["route"])):
-            edge = edges_taken.loc[leg["route"][i][0]]
-            edge_coords = list(edge["geometry"].coords)
-            edge_coords = [p[::-1] for p in edge_coords]
-            if i + 1 < len(leg["route"]):
-                edge_exit = leg["route"][i + 1][1]
-            else:
-                edge_exit = leg["arrival_time"]
-            edge_tt = edge_exit - leg["route"][i][1]
-            congestion = edge["fftt"] / edge_tt
-            color = to_hex(colormap(congestion))
+        edge_ids = [edge_id for edge_id, _ in leg["route"]]
+        # Entry time of each edge, followed by the exit time of the last edge.
+        times = [edge_entry for _, edge_entry in leg["route"]] + [leg["arrival_time"]]
+        edge_tts = np.diff(times)
+        fftts = np.array([edge_fftt[edge_id] for edge_id in edge_ids])
+        colors = [to_hex(c) for c in colormap(fftts / edge_tts)]
+        for edge_id, edge_entry, edge_exit, edge_tt, fftt, color in zip(
+            edge_ids, times[:-1], times[1:], edge_tts.tolist(), fftts.tolist(), colors
+        ):
             tooltip = "From {} to {}<br>Travel time: {}<br>Free-flow tt: {}".format(
-                get_time_str(leg["route"][i][1]),
+                get_time_str(edge_entry),
                 get_time_str(edge_exit),
                 get_tt_str(edge_tt),
-                get_tt_str(edge["fftt"]),
+                get_tt_str(fftt),
             )
             PolyLine(
-                locations=edge_coords, tooltip=tooltip, opacity=0.5, color=color, weight=10
+                locations=edge_coords[edge_id],
+                tooltip=tooltip,
+                opacity=0.5,
+                color=color,
+                weight=10,
             ).add_to(m)
     return m
 
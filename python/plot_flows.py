@@ -1,7 +1,6 @@
-import json
-from collections import defaultdict
-
+import numpy as np
 import geopandas as gpd
+import orjson
 import zstandard as zstd
 
 # Path to the output agent results file.
@@ -13,22 +12,26 @@ EDGE_FILENAME = "../MetropolisIDF/output/here_network/edges.fgb"
 def get_agent_results():
     dctx = zstd.ZstdDecompressor()
     with open(AGENT_RESULTS_FILENAME, "br") as f:
-        reader = dctx.stream_reader(f)
-        data = json.load(reader)
+        data = orjson.loads(dctx.stream_reader(f).read())
     return data
 
 
 def get_edges():
-    edges = gpd.read_file(EDGE_FILENAME)
+    edges = gpd.read_file(EDGE_FILENAME, engine="pyogrio", use_arrow=True)
     return edges
 
 
-def get_flow_counts(agent_results):
-    flows = defaultdict(lambda: 0)
-    for agent in agent_results:
-        for leg in agent['mode_results']['value']['legs']:
-            if leg['class']['type'] != 'Road':
-                continue
-            for edge in leg['class']['value']['route']:
-                flows[edge[0]] += 1
-    return flows
+def get_flow_counts(agent_results, nb_edges=0):
+    """Returns the array of the number of times each edge is taken (indexed by edge id, with
+    `nb_edges` values at least)."""
+    edge_ids = np.fromiter(
+        (
+            edge[0]
+            for agent in agent_results
+            for leg in agent['mode_results']['value']['legs']
+            if leg['class']['type'] == 'Road'
+            for edge in leg['class']['value']['route']
+        ),
+        dtype=np.int64,
+    )
+    return np.bincount(edge_ids, minlength=nb_edges)
@@ -1,8 +1,7 @@
-import json
-
 import numpy as np
 import pandas as pd
 import geopandas as gpd
+import orjson
 import zstandard as zstd
 import matplotlib.pyplot as plt
 
@@ -19,31 +18,34 @@ INTERVAL = 300.0
 def get_weight_results():
     dctx = zstd.ZstdDecompressor()
     with open(WEIGHT_RESULTS_FILENAME, "br") as f:
-        reader = dctx.stream_reader(f)
-        data = json.load(reader)
+        data = orjson.loads(dctx.stream_reader(f).read())
     return data
 
 
 def get_edges():
-    edges = gpd.read_file(EDGE_FILENAME)
+    edges = gpd.read_file(EDGE_FILENAME, engine="pyogrio", use_arrow=True)
     return edges
 
 
 def get_edge_with_congestion(edges, weights, each=INTERVAL):
     xs = np.arange(PERIOD[0], PERIOD[1] + INTERVAL, INTERVAL)
     bins = np.arange(PERIOD[0], PERIOD[1] + each, each)
-    array = np.empty((len(weights["road_network"][0]), len(bins)))
-    for i, w in enumerate(weights["road_network"][0]):
-        if isinstance(w, float):
-            array[i, :] = w
-        else:
-            ys = np.interp(bins, xs, np.array(w["points"]))
-            assert len(ys) == len(
-                bins
-            ), "Weights are incompatible with the recording period and interval"
-            array[i, :] = ys
-    ff_weights = np.min(array, axis=1)
-    array /= np.atleast_2d(ff_weights).T
+    road_weights = weights["road_network"][0]
+    array = np.empty((len(road_weights), len(bins)))
+    is_constant = np.fromiter(
+        (isinstance(w, float) for w in road_weights), dtype=bool, count=len(road_weights)
+    )
+    array[is_constant, :] = np.array([w for w in road_weights if isinstance(w, float)])[:, None]
+    points = np.array([w["points"] for w in road_weights if not isinstance(w, float)])
+    if len(points):
+        assert (
+            points.shape[1] == len(xs)
+        ), "Weights are incompatible with the recording period and interval"
+        # Interpolate all the piecewise-linear weights at once (they share the same breakpoints).
+        idx = np.clip(np.searchsorted(xs, bins, side="right") - 1, 0, len(xs) - 2)
+        frac = np.clip((bins - xs[idx]) / (xs[idx + 1] - xs[idx]), 0.0, 1.0)
+        array[~is_constant, :] = points[:, idx] * (1.0 - frac) + points[:, idx + 1] * frac
+    array /= array.min(axis=1, keepdims=True)
     wdf = pd.DataFrame(array, columns=[f"TD{i}" for i in range(len(bins))], dtype=float)
     return pd.concat((edges, wdf), axis=1)
 
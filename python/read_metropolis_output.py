@@ -1,10 +1,10 @@
 from collections import defaultdict
 import os
-import json
 
 import numpy as np
 import pandas as pd
 import geopandas as gpd
+import orjson
 import folium
 from folium.vector_layers import Circle, PolyLine
 import matplotlib as mpl
@@ -27,32 +27,29 @@ EDGE_FILENAME = "./output/osm_network/osm_edges_server.fgb"
 
 
 def get_agents():
-    with open(AGENT_INPUT_FILENAME, "r") as f:
-        agents = json.load(f)
+    with open(AGENT_INPUT_FILENAME, "rb") as f:
+        agents = orjson.loads(f.read())
     return agents
 
 
 def get_agent_results():
     dctx = zstd.ZstdDecompressor()
     with open(AGENT_RESULTS_FILENAME, "br") as f:
-        reader = dctx.stream_reader(f)
-        data = json.load(reader)
+        data = orjson.loads(dctx.stream_reader(f).read())
     return data
 
 
 def get_weight_results():
     dctx = zstd.ZstdDecompressor()
     with open(WEIGHT_RESULTS_FILENAME, "br") as f:
-        reader = dctx.stream_reader(f)
-        data = json.load(reader)
+        data = orjson.loads(dctx.stream_reader(f).read())
     return data
 
 
 def get_skim_results():
     dctx = zstd.ZstdDecompressor()
     with open(SKIM_RESULTS_FILENAME, "br") as f:
-        reader = dctx.stream_reader(f)
-        data = json.load(reader)
+        data = orjson.loads(dctx.stream_reader(f).read())
     return data
 
 
@@ -91,7 +88,7 @@ def get_filtered_egt_data(
 
 
 def get_edges():
-    edges = gpd.read_file(EDGE_FILENAME)
+    edges = gpd.read_file(EDGE_FILENAME, engine="pyogrio", use_arrow=True)
     # TODO: Remove this when the input of Metropolis is fixed.
     edges["index"] = edges.index
     return edges
@@ -1,6 +1,6 @@
-import json
-
+import numpy as np
 import geopandas as gpd
+import orjson
 
 # Path to the file where the edge files are stored.
 EDGES_FILE = "./output/osm_network/osm_edges_server.fgb"
@@ -8,21 +8,29 @@ EDGES_FILE = "./output/osm_network/osm_edges_server.fgb"
 OUTPUT_FILE = "./output/routing/routing_graph.json"
 
 print("Reading edges")
-edges = gpd.read_file(EDGES_FILE)
+edges = gpd.read_file(
+    EDGES_FILE,
+    engine="pyogrio",
+    use_arrow=True,
+    # The `where` column must be read for the filter to apply on FlatGeobuf files.
+    columns=["source", "target", "length", "speed", "main", "index_main"],
+    where="main = 1",
+    read_geometry=False,
+)
 
-edges = edges.loc[edges['main']].copy()
-edges.sort_values('index_main', inplace=True)
+# The main edges are indexed from 0 to n-1 so they can be put in order without sorting.
+order = np.empty(len(edges), dtype=np.int64)
+order[edges['index_main'].to_numpy()] = np.arange(len(edges))
+edges = edges.iloc[order]
 
 print("Creating routing graph")
-metro_edges = list()
-for _, row in edges.iterrows():
-    edge = [
-        row["source"],
-        row["target"],
-        row['length'] / (row['speed'] / 3.6), # Travel time in seconds.
-    ]
-    metro_edges.append(edge)
+# Travel time in seconds.
+travel_times = edges['length'].to_numpy(float) / (edges['speed'].to_numpy(float) / 3.6)
+metro_edges = [
+    list(edge)
+    for edge in zip(edges["source"].tolist(), edges["target"].tolist(), travel_times.tolist())
+]
 
 print("Writing data...")
-with open(OUTPUT_FILE, "w") as f:
-    f.write(json.dumps(metro_edges))
+with open(OUTPUT_FILE, "wb") as f:
+    f.write(orjson.dumps(metro_edges))